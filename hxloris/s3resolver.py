@@ -4,22 +4,185 @@
 #   https://github.com/Harvard-ATG/loris/blob/development/loris/s3resolver.py
 #
 
-import glob
+import collections
+import concurrent.futures
+import errno
+import functools
 import logging
 import os
+import re
+import shutil
 import tempfile
+import threading
+import time
 from urllib.parse import unquote
 
 import boto3
+import boto3.s3.transfer
+import botocore.config
+from botocore.exceptions import ClientError
 from loris import constants
-from loris.identifiers import CacheNamer, IdentRegexChecker
+from loris.identifiers import CacheNamer
 from loris.img_info import ImageInfo
 from loris.loris_exception import ResolverException
 from loris.resolver import _AbstractResolver
-from loris.utils import safe_rename
 
 logger = logging.getLogger(__name__)
 
+# botocore defaults to a pool of 10 connections, easily exhausted by concurrent
+# cache misses; override with config `s3_max_pool_connections`
+DEFAULT_MAX_POOL_CONNECTIONS = 64
+
+# max number of idents memoized by ident parsing helpers
+IDENT_CACHE_SIZE = 4096
+
+# seconds a positive is_resolvable() is remembered, and max idents remembered
+DEFAULT_RESOLVABLE_CACHE_TTL = 60
+RESOLVABLE_CACHE_SIZE = 8192
+
+# seconds a not found is_resolvable() is remembered, and max idents remembered
+DEFAULT_UNRESOLVABLE_CACHE_TTL = 30
+UNRESOLVABLE_CACHE_SIZE = 8192
+
+# seconds a listing of rules files in an s3 "dir" is remembered, 0 disables
+# listing; and max number of listings remembered
+DEFAULT_RULES_LISTING_TTL = 0
+RULES_LISTING_CACHE_SIZE = 1024
+
+# fetches that can run alongside the image download (i.e. rules files); one
+# slot per worker, so a fetch never waits in the executor queue
+EXECUTOR_WORKERS = 8
+_EXECUTOR = concurrent.futures.ThreadPoolExecutor(
+    max_workers=EXECUTOR_WORKERS, thread_name_prefix="s3resolver"
+)
+_EXECUTOR_SLOTS = threading.BoundedSemaphore(EXECUTOR_WORKERS)
+
+# buffer size when streaming s3 objects into the cache
+COPY_BUFSIZE = 1024 * 1024
+
+# objects above multipart_threshold are downloaded in parallel ranged GETs
+_TRANSFER_CFG = boto3.s3.transfer.TransferConfig(
+    multipart_threshold=16 * 1024 * 1024,
+    multipart_chunksize=8 * 1024 * 1024,
+    max_concurrency=8,
+    use_threads=True,
+)
+
+# error codes for a missing s3 object; responses to HEAD requests have no body,
+# so botocore can only report the http status
+# os.link errors meaning the filesystem has no hard links
+NO_HARDLINK_ERRNOS = (errno.EPERM, errno.ENOTSUP, errno.EOPNOTSUPP)
+
+S3_NOT_FOUND_CODES = ("NoSuchKey", "NotFound", "404")
+
+
+@functools.lru_cache(maxsize=None)
+def _s3_client(max_pool_connections=DEFAULT_MAX_POOL_CONNECTIONS):
+    """returns the process-wide s3 client for a given pool size.
+
+    sharing the client means sharing its pool of keep-alive connections, so
+    resolves don't pay a tcp+tls handshake each time.
+    thread safe, but not fork safe: a resolver created before a fork (e.g. wsgi
+    preload) shares its client, and connections, with the forked workers.
+    https://boto3.amazonaws.com/v1/documentation/api/latest/guide/clients.html#multithreading-or-multiprocessing-with-clients
+    """
+    session = boto3.session.Session()
+    return session.client(
+        "s3",
+        config=botocore.config.Config(
+            max_pool_connections=max_pool_connections,
+            retries={"max_attempts": 3, "mode": "standard"},
+        ),
+    )
+
+
+@functools.lru_cache(maxsize=IDENT_CACHE_SIZE)
+def _unquote(ident):
+    """urllib.parse.unquote, skipped when there is nothing to unquote."""
+    return unquote(ident) if "%" in ident else ident
+
+
+@functools.lru_cache(maxsize=IDENT_CACHE_SIZE)
+def _cache_dir_name(ident):
+    """CacheNamer.cache_directory_name, memoized since it hashes the ident."""
+    return CacheNamer.cache_directory_name(ident=ident)
+
+
+def _is_not_found(error):
+    """returns True if botocore ClientError means s3 object does not exist."""
+    return error.response.get("Error", {}).get("Code") in S3_NOT_FOUND_CODES
+
+
+def _submit_if_idle(fn, *args):
+    """runs fn(*args) in _EXECUTOR if a worker is free.
+
+    returns the future, or None when all workers are busy: then the caller
+    runs fn itself, rather than wait for other requests' fetches.
+    """
+    if not _EXECUTOR_SLOTS.acquire(blocking=False):
+        return None
+    future = _EXECUTOR.submit(fn, *args)
+    # also called when future is cancelled
+    future.add_done_callback(lambda f: _EXECUTOR_SLOTS.release())
+    return future
+
+
+def _cache_temp_file(cache_dir):
+    """returns a new NamedTemporaryFile in cache_dir, creating cache_dir.
+
+    a failed copy_to_cache for the same ident removes cache_dir when empty,
+    possibly in between makedirs and creating the file; so try again once.
+    """
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        return tempfile.NamedTemporaryFile(dir=cache_dir, delete=False)
+    except FileNotFoundError:
+        os.makedirs(cache_dir, exist_ok=True)
+        return tempfile.NamedTemporaryFile(dir=cache_dir, delete=False)
+
+
+# marks a key missing from a _TTLCache holding None values
+_MISSING = object()
+
+
+class _TTLCache(object):
+    """thread safe mapping whose entries expire `ttl` seconds after set.
+
+    when more than `maxsize` entries, the oldest are dropped; `ttl <= 0`
+    disables the cache.
+    """
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value, expires_at = self._data[key]
+            except KeyError:
+                return default
+            if expires_at <= time.monotonic():
+                del self._data[key]
+                return default
+            return value
+
+    def set(self, key, value):
+        if self.ttl <= 0:
+            return
+        with self._lock:
+            # re-insert so entries stay ordered by expiration
+            self._data.pop(key, None)
+            self._data[key] = (value, time.monotonic() + self.ttl)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
 
 class S3Resolver(_AbstractResolver):
     """Resolver for image files stored on aws s3 buckets.
@@ -47,6 +210,24 @@ class S3Resolver(_AbstractResolver):
             bucket = 'bucket-for-site2'
             key_prefix = 'loris/other-images'
 
+        # max number of http connections kept open to s3, shared by all
+        # resolvers in the process
+        # optional, default is 64
+        s3_max_pool_connections = 64
+
+        # seconds to remember that an ident is resolvable, 0 to disable
+        # optional, default is 60
+        resolvable_cache_ttl = 60
+
+        # seconds to remember that an ident is not found in s3, 0 to disable
+        # optional, default is 30
+        unresolvable_cache_ttl = 30
+
+        # seconds to remember which rules files exist next to images, 0 to
+        # disable; requires s3:ListBucket permission
+        # optional, default is 0
+        rules_listing_ttl = 0
+
         ...
 
     an incoming request url and its corresponding s3 bucket/prefix:
@@ -67,9 +248,10 @@ class S3Resolver(_AbstractResolver):
         super(S3Resolver, self).__init__(config)
         self.default_format = self.config.get("default_format", None)
 
-        self._ident_regex_checker = IdentRegexChecker(
-            ident_regex=self.config.get("ident_regex")
-        )
+        # same check as loris.identifiers.IdentRegexChecker, without the extra
+        # call on every request
+        ident_regex = self.config.get("ident_regex")
+        self._ident_re = re.compile(ident_regex) if ident_regex else None
         self._cache_namer = CacheNamer()
 
         if "cache_root" in self.config:
@@ -81,25 +263,81 @@ class S3Resolver(_AbstractResolver):
             )
             logger.error(message)
             raise ResolverException(message)
+        # cache_root with trailing separator, to build paths by concatenation
+        self._cache_root_sep = os.path.join(self.cache_root, "")
 
         self.has_bucket_map = False
+        # maps bucket placeholder to (bucketname, key_prefix ending in "/")
+        self._bucket_targets = {}
         if "bucket_map" in config:
             self.bucket_map = config["bucket_map"]
             self.has_bucket_map = True
-            logger.debug("s3 bucket_map: {}".format(self.bucket_map))
+            logger.debug("s3 bucket_map: %s", self.bucket_map)
+            for bucket, target in self.bucket_map.items():
+                key_prefix = target.get("key_prefix", "")
+                if key_prefix and not key_prefix.endswith("/"):
+                    key_prefix += "/"
+                self._bucket_targets[bucket] = (target["bucket"], key_prefix)
 
         # boto3: if not in us-east-1, set envvar AWS_DEFAULT_REGION to avoid extra
         # requests when downloading from s3
-        # thread safe:
-        # https://boto3.amazonaws.com/v1/documentation/api/latest/guide/resources.html#multithreading-multiprocessing
-        session = boto3.session.Session()
-        self.s3 = session.resource("s3")
+        max_pool_connections = int(
+            self.config.get("s3_max_pool_connections", DEFAULT_MAX_POOL_CONNECTIONS)
+        )
+        # a single cold miss may use transfer threads for the image, plus one
+        # connection for the rules file; a smaller pool discards connections
+        # (losing keep-alive) whenever that happens
+        if max_pool_connections < _TRANSFER_CFG.max_concurrency + 1:
+            logger.warning(
+                "s3_max_pool_connections(%s) is less than connections used to "
+                "download one image(%s)",
+                max_pool_connections,
+                _TRANSFER_CFG.max_concurrency + 1,
+            )
+        self.s3 = _s3_client(max_pool_connections)
+
+        # viewers hit is_resolvable() once per tile, so remember positives for a
+        # little while to save the HEAD requests. The tradeoff is staleness: an
+        # image deleted from s3 may still be reported as resolvable until ttl
+        # expires (and copy_to_cache fails).
+        self._resolvable_cache = _TTLCache(
+            maxsize=RESOLVABLE_CACHE_SIZE,
+            ttl=float(
+                self.config.get("resolvable_cache_ttl", DEFAULT_RESOLVABLE_CACHE_TTL)
+            ),
+        )
+        # same for idents not found in s3 (typos, broken links, scanners), so
+        # repeated requests don't reach s3. Kept shorter: a newly uploaded image
+        # is reported as not found until ttl expires.
+        self._unresolvable_cache = _TTLCache(
+            maxsize=UNRESOLVABLE_CACHE_SIZE,
+            ttl=float(
+                self.config.get(
+                    "unresolvable_cache_ttl", DEFAULT_UNRESOLVABLE_CACHE_TTL
+                )
+            ),
+        )
+
+        # images in the same s3 "dir" are usually requested together; one LIST
+        # tells which of them have a rules file, instead of a GET per image.
+        # A rules file uploaded after the listing is missed until ttl expires,
+        # and then for good for images cached meanwhile, hence disabled by default
+        self._rules_listing = _TTLCache(
+            maxsize=RULES_LISTING_CACHE_SIZE,
+            ttl=float(self.config.get("rules_listing_ttl", DEFAULT_RULES_LISTING_TTL)),
+        )
+
+        # parsing an ident is deterministic for a given config, and the same
+        # ident is resolved over and over (one request per tile)
+        self.s3bucket_from_ident = functools.lru_cache(maxsize=IDENT_CACHE_SIZE)(
+            self.s3bucket_from_ident
+        )
 
-        logger.info("loaded s3 resolver with config: {}".format(config))
+        logger.info("loaded s3 resolver with config: %s", config)
 
     def raise_404_for_ident(self, ident):
         message = "Source image not found for identifier: %s." % (ident,)
-        logger.warn(message)
+        logger.warning(message)
         raise ResolverException(message)
 
     def is_resolvable(self, ident):
@@ -107,40 +345,53 @@ class S3Resolver(_AbstractResolver):
 
         this generates a head request for the s3 object
         """
-        ident = unquote(ident)
+        ident = _unquote(ident)
+
+        if self._resolvable_cache.get(ident):
+            return True
 
-        if not self._ident_regex_checker.is_allowed(ident):
+        if self._ident_re is not None and not self._ident_re.match(ident):
             return False
 
-        fp = self.cache_dir_path(ident=ident)
+        if self._unresolvable_cache.get(ident):
+            return False
+
+        fp = self.cache_dir_path(ident)
         if os.path.exists(fp):
             return True
         else:
             try:
                 (bucketname, keyname) = self.s3bucket_from_ident(ident)
             except ResolverException as e:
-                logger.warn(e)
+                logger.warning(e)
                 return False
 
             # check that we can get to this object on s3
-            # access to s3obj prop generates a head request or 404
+            # head request or 404
             try:
-                s3obj = self.s3.Object(bucketname, keyname)
-                content_length = s3obj.content_length
+                content_length = self.s3.head_object(Bucket=bucketname, Key=keyname)[
+                    "ContentLength"
+                ]
+            except ClientError as e:
+                if _is_not_found(e):
+                    self._unresolvable_cache.set(ident, True)
+                    logger.warning("s3 object not found (%s:%s)", bucketname, keyname)
+                else:
+                    logger.error(
+                        "unable to access s3 object (%s:%s): %s", bucketname, keyname, e
+                    )
+                return False
             except Exception as e:
                 logger.error(
-                    "unable to access s3 object ({}:{}): {}".format(
-                        bucketname, keyname, e
-                    )
+                    "unable to access s3 object (%s:%s): %s", bucketname, keyname, e
                 )
                 return False
             else:
                 if content_length > 0:
+                    self._resolvable_cache.set(ident, True)
                     return True
                 else:
-                    logger.warning(
-                        "empty s3 object ({}:{})".format(bucketname, keyname)
-                    )
+                    logger.warning("empty s3 object (%s:%s)", bucketname, keyname)
                     return False
 
     def get_format(self, ident, potential_format):
@@ -162,43 +413,43 @@ class S3Resolver(_AbstractResolver):
             )
 
         # check if bucketname actually means something different
-        if self.has_bucket_map and bucket in self.bucket_map:
-            bucketname = self.bucket_map[bucket]["bucket"]
-            if "key_prefix" in self.bucket_map[bucket]:
-                keyname = os.path.join(
-                    self.bucket_map[bucket]["key_prefix"], partial_key
-                )
-            else:
-                keyname = partial_key
-            return (bucketname, keyname)
+        target = self._bucket_targets.get(bucket)
+        if target is not None:
+            (bucketname, key_prefix) = target
+            return (bucketname, key_prefix + partial_key)
 
         else:  # what came in ident is the actual bucketname
             return (bucket, partial_key)
 
     def cache_dir_path(self, ident):
         # build dir path for ident file in cache
-        return os.path.join(
-            self.cache_root, CacheNamer.cache_directory_name(ident=ident)
-        )
+        return self._cache_root_sep + _cache_dir_name(ident)
 
     def cached_file_for_ident(self, ident):
         # recover filepath for ident in cache
-        cache_dir = self.cache_dir_path(ident)
-        if os.path.exists(cache_dir):
-            files = glob.glob(os.path.join(cache_dir, "loris_cache.*"))
-            if files:
-                return files[0]
+        # the rules file lives in the same dir, and is not the image
+        rules_fn = "loris_cache." + self.auth_rules_ext
+        try:
+            with os.scandir(self.cache_dir_path(ident)) as entries:
+                for entry in entries:
+                    if entry.name.startswith("loris_cache.") and entry.name != rules_fn:
+                        return entry.path
+        except FileNotFoundError:
+            pass
         return None
 
     def cache_file_extension(self, ident, content_type=None):
+        if self.default_format is not None:
+            # get_format() returns it regardless of content_type
+            return self.default_format
         if content_type is not None:
             try:
                 extension = self.get_format(
                     ident, constants.FORMATS_BY_MEDIA_TYPE[content_type]
                 )
             except KeyError:
-                logger.warn(
-                    "wonky s3 resource content-type({}) for ident({})",
+                logger.warning(
+                    "wonky s3 resource content-type(%s) for ident(%s)",
                     content_type,
                     ident,
                 )
@@ -210,72 +461,243 @@ class S3Resolver(_AbstractResolver):
 
     def copy_to_cache(self, ident):
         """ downloads image source file from s3, if not in cache already."""
-        ident = unquote(ident)
+        ident = _unquote(ident)
 
         # get source image and write to temporary file
         (bucketname, keyname) = self.s3bucket_from_ident(ident)
 
+        # content-type comes with the GET response, no need for a HEAD.
+        # Nothing is written to the cache before the GET succeeds: an existing
+        # cache dir means resolvable to is_resolvable()
         try:
-            s3obj = self.s3.Object(bucketname, keyname)
-            content_type = s3obj.content_type
+            resp = self.s3.get_object(Bucket=bucketname, Key=keyname)
+        except ClientError as e:
+            self._resolvable_cache.pop(ident)
+            if _is_not_found(e):
+                self._unresolvable_cache.set(ident, True)
+                self.raise_404_for_ident(ident)
+            msg = "unable to access s3 object ({}:{}): {}".format(
+                bucketname, keyname, e
+            )
+            logger.error(msg)
+            raise ResolverException(msg)
         except Exception as e:
-            msg = "no content_type for s3 object ({}:{}): {}".format(
+            self._resolvable_cache.pop(ident)
+            msg = "unable to access s3 object ({}:{}): {}".format(
                 bucketname, keyname, e
             )
             logger.error(msg)
             raise ResolverException(msg)
 
-        extension = self.cache_file_extension(ident, content_type)
+        # may raise for an unknown content-type and no extension in ident;
+        # find out before writing anything to disk
+        try:
+            extension = self.cache_file_extension(ident, resp.get("ContentType"))
+        except Exception:
+            resp["Body"].close()
+            raise
+
+        # rules file is independent from the image, fetch it while the image
+        # body is read; submitted once the image is known to exist
+        rules_future = _submit_if_idle(
+            self.fetch_rules_file, ident, bucketname, keyname
+        )
+
         cache_dir = self.cache_dir_path(ident)
-        os.makedirs(cache_dir, exist_ok=True)
-        local_fp = os.path.join(cache_dir, "loris_cache." + extension)
-        with tempfile.NamedTemporaryFile(dir=cache_dir, delete=False) as tmp_file:
+        try:
+            tmp_file = _cache_temp_file(cache_dir)
+        except OSError as e:
+            resp["Body"].close()
+            self._discard_cache_dir(cache_dir, rules_future)
+            msg = "unable to save s3 object ({}:{}): {}".format(bucketname, keyname, e)
+            logger.error(msg)
+            raise ResolverException(msg)
+
+        with tmp_file:
             try:
-                self.s3.Bucket(bucketname).download_fileobj(keyname, tmp_file)
+                if resp["ContentLength"] < _TRANSFER_CFG.multipart_threshold:
+                    shutil.copyfileobj(resp["Body"], tmp_file, COPY_BUFSIZE)
+                else:
+                    resp["Body"].close()
+                    self.s3.download_fileobj(
+                        bucketname, keyname, tmp_file, Config=_TRANSFER_CFG
+                    )
             except Exception as e:
+                os.remove(tmp_file.name)
+                self._resolvable_cache.pop(ident)
+                self._discard_cache_dir(cache_dir, rules_future)
                 msg = "unable to access or save s3 object ({}:{}): {}".format(
                     bucketname, keyname, e
                 )
                 logger.error(msg)
                 raise ResolverException(msg)
 
-        # Now rename the temp file to the desired file name if it still
+        # rules file goes in before the image is published: a cached image is
+        # served with whatever rules are next to it
+        rules = self._fetched_rules(rules_future, ident, bucketname, keyname)
+        if rules is not None:
+            self.save_rules_to_cache(ident, cache_dir, rules)
+
+        # temp file is in cache_dir, so publishing it below is still atomic
+        local_fp = os.path.join(cache_dir, "loris_cache." + extension)
+
+        # Now link the temp file to the desired file name if it still
         # doesn't exist (another process could have created it).
         #
-        # Note: This is purely an optimisation; if the file springs into
-        # existence between the existence check and the copy, it will be
-        # overridden.
-        if os.path.exists(local_fp):
-            logger.info("Another process downloaded src image {}".format(local_fp))
+        # A hard link is created atomically, and fails if the name is taken,
+        # so a complete file is published exactly once.
+        try:
+            os.link(tmp_file.name, local_fp)
+        except FileExistsError:
+            logger.info("Another process downloaded src image %s", local_fp)
             os.remove(tmp_file.name)
+            return local_fp
+        except OSError as e:
+            if e.errno not in NO_HARDLINK_ERRNOS:
+                os.remove(tmp_file.name)
+                msg = "unable to save s3 object ({}:{}) to {}: {}".format(
+                    bucketname, keyname, local_fp, e
+                )
+                logger.error(msg)
+                raise ResolverException(msg)
+            # filesystem without hard links: rename is atomic too, but may
+            # replace a file another process published meanwhile (same image)
+            os.replace(tmp_file.name, local_fp)
         else:
-            safe_rename(tmp_file.name, local_fp)
-            logger.info("Copied {}:{} to {}".format(bucketname, keyname, local_fp))
+            os.remove(tmp_file.name)
+        logger.info("Copied %s:%s to %s", bucketname, keyname, local_fp)
+
+        return local_fp
 
-        # Check for rules file associated with image file
-        # These files are < 2k in size, so fetch in one go.
+    def _fetched_rules(self, rules_future, ident, bucketname, keyname):
+        """waits for the rules fetch, or does it now if it wasn't submitted."""
+        if rules_future is None:
+            return self.fetch_rules_file(ident, bucketname, keyname)
+        try:
+            return rules_future.result()
+        except Exception as e:
+            # a rules file is optional, never fail the image because of it
+            logger.warning("unable to fetch rules file for ident(%s): %s", ident, e)
+            return None
+
+    def _discard_cache_dir(self, cache_dir, rules_future):
+        """cleans up after a failed copy_to_cache."""
+        # don't leave the rules fetch running past the request
+        if rules_future is not None and not rules_future.cancel():
+            try:
+                rules_future.result()
+            except Exception:
+                pass
+
+        # don't leave an empty cache dir behind; fails if another process is
+        # caching the same image
+        try:
+            os.rmdir(cache_dir)
+        except OSError:
+            pass
+
+    def fetch_rules_file(self, ident, bucketname, keyname):
+        """ returns contents of rules file associated with image file, if any."""
         # Assumes that the rules will be next to the image
+        (prefix, rules_keyname) = self.rules_keyname(keyname)
+
+        rules_keys = self.rules_files_in_prefix(bucketname, prefix)
+        if rules_keys is not None and rules_keyname not in rules_keys:
+            return None
+
+        try:
+            # single GET; most images have no rules file, so a 404 is expected
+            resp = self.s3.get_object(Bucket=bucketname, Key=rules_keyname)
+            # These files are < 2k in size, so fetch in one go.
+            data = resp["Body"].read()
+        except ClientError as e:
+            if not _is_not_found(e):
+                logger.warning(
+                    "ignoring rules file(%s/%s) for ident(%s): %s",
+                    bucketname,
+                    rules_keyname,
+                    ident,
+                    e,
+                )
+            return None
+        except Exception as e:
+            # no connection available?
+            logger.warning(
+                "ignoring rules file(%s/%s) for ident(%s): %s",
+                bucketname,
+                rules_keyname,
+                ident,
+                e,
+            )
+            return None
+        return data
+
+    def save_rules_to_cache(self, ident, cache_dir, rules):
+        """ writes rules file contents next to the image in cache_dir."""
         # cache_dir is image specific, so this is easy
-        bits = os.path.split(keyname)  # === bash basename
-        fn = bits[1].rsplit(".")[0] + "." + self.auth_rules_ext
-        rules_keyname = bits[0] + "/" + fn
         local_rules_fp = os.path.join(cache_dir, "loris_cache." + self.auth_rules_ext)
         try:
-            self.s3.Object(bucketname, rules_keyname).download_file(local_rules_fp)
+            with tempfile.NamedTemporaryFile(dir=cache_dir, delete=False) as tmp_file:
+                tmp_file.write(rules)
+            os.replace(tmp_file.name, local_rules_fp)
+        except OSError as e:
+            logger.warning("unable to save rules file for ident(%s): %s", ident, e)
+
+    def rules_keyname(self, keyname):
+        """returns tuple(prefix, rules_keyname) for image keyname.
+
+        s3 keys are always "/" separated; the rules file is named after the
+        image file, up to its first ".".
+        """
+        (dirname, sep, basename) = keyname.rpartition("/")
+        prefix = dirname + sep
+        return (prefix, prefix + basename.partition(".")[0] + "." + self.auth_rules_ext)
+
+    def rules_files_in_prefix(self, bucketname, prefix):
+        """returns set of rules file keys right under prefix.
+
+        returns None if listing is disabled or not allowed; then the caller
+        has to check for the rules file itself.
+        """
+        if self._rules_listing.ttl <= 0:
+            return None
+
+        rules_keys = self._rules_listing.get((bucketname, prefix), _MISSING)
+        if rules_keys is not _MISSING:
+            return rules_keys
+
+        suffix = "." + self.auth_rules_ext
+        try:
+            rules_keys = set()
+            paginator = self.s3.get_paginator("list_objects_v2")
+            for page in paginator.paginate(
+                Bucket=bucketname, Prefix=prefix, Delimiter="/"
+            ):
+                rules_keys.update(
+                    obj["Key"]
+                    for obj in page.get("Contents", [])
+                    if obj["Key"].endswith(suffix)
+                )
         except Exception as e:
-            # no connection available?
-            msg = "ignoring rules file({}/{}) for ident({}): {}".format(
-                bucketname, rules_keyname, ident, e
+            # missing s3:ListBucket permission?
+            logger.warning(
+                "unable to list rules files in (%s:%s): %s", bucketname, prefix, e
             )
-            logger.warn(msg)
+            rules_keys = None
 
-        return local_fp
+        self._rules_listing.set((bucketname, prefix), rules_keys)
+        return rules_keys
 
     def resolve(self, app, ident, base_uri):
-        if not self.is_resolvable(ident):
-            self.raise_404_for_ident(ident)
-        cached_file_path = self.cached_file_for_ident(ident)
+        # most of the time the image is in the cache already, so look for it
+        # first and skip the checks in is_resolvable()
+        cached_file_path = None
+        unquoted_ident = _unquote(ident)
+        if self._ident_re is None or self._ident_re.match(unquoted_ident):
+            cached_file_path = self.cached_file_for_ident(unquoted_ident)
         if not cached_file_path:
+            if not self.is_resolvable(ident):
+                self.raise_404_for_ident(ident)
             cached_file_path = self.copy_to_cache(ident)
         format_ = self.get_format(cached_file_path, None)
         auth_rules = self.get_auth_rules(ident, cached_file_path)
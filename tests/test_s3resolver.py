@@ -1,6 +1,17 @@
 # Sample Test passing with nose and pytest
 
-from hxloris.s3resolver import S3Resolver
+import errno
+import io
+import logging
+import os
+import threading
+
+import pytest
+from botocore.response import StreamingBody
+from botocore.stub import Stubber
+from hxloris import s3resolver
+from hxloris.s3resolver import _TRANSFER_CFG, S3Resolver, _cache_temp_file, _TTLCache
+from loris.loris_exception import ResolverException
 
 config = {
     "impl": "hxloris.s3resolver.S3Resolver",
@@ -34,6 +45,40 @@ def test_bucket_from_ident_ok():
     assert b == "its_not_a_bucket"
 
 
+def test_bucket_from_ident_memoized():
+    r = S3Resolver(config)
+    ident = "iiif/image.jpg/region/size/rotation/default.jpg"
+
+    assert r.s3bucket_from_ident(ident) == r.s3bucket_from_ident(ident)
+    assert r.s3bucket_from_ident.cache_info().hits == 1
+
+
+def test_rules_keyname():
+    r = S3Resolver(config)
+    ext = r.auth_rules_ext
+
+    assert r.rules_keyname("hx/this/image.jpg") == (
+        "hx/this/",
+        "hx/this/image." + ext,
+    )
+    assert r.rules_keyname("image.tar.gz") == ("", "image." + ext)
+
+
+def test_cached_file_for_ident(tmp_path):
+    r = S3Resolver(dict(config, cache_root=str(tmp_path)))
+    ident = "iiif/image.jpg"
+
+    assert r.cached_file_for_ident(ident) is None
+
+    cache_dir = r.cache_dir_path(ident)
+    os.makedirs(cache_dir)
+    open(os.path.join(cache_dir, "loris_cache." + r.auth_rules_ext), "w").close()
+    assert r.cached_file_for_ident(ident) is None
+
+    open(os.path.join(cache_dir, "loris_cache.jpg"), "w").close()
+    assert r.cached_file_for_ident(ident) == os.path.join(cache_dir, "loris_cache.jpg")
+
+
 def test_config_no_bucket_map():
     del config["bucket_map"]
     r = S3Resolver(config)
@@ -43,3 +88,475 @@ def test_config_no_bucket_map():
 
     b, k = r.s3bucket_from_ident("iiif/image.jpg/region/size/rotation/default.jpg")
     assert b == "iiif"
+
+
+def test_ttl_cache():
+    c = _TTLCache(maxsize=2, ttl=60)
+    c.set("a", True)
+    c.set("b", True)
+    c.set("c", True)
+
+    assert c.get("a") is None  # oldest dropped
+    assert c.get("b")
+    c.pop("b")
+    assert c.get("b") is None
+
+    c = _TTLCache(maxsize=2, ttl=0)
+    c.set("a", True)
+    assert c.get("a") is None
+
+
+@pytest.fixture
+def resolver(tmp_path):
+    return S3Resolver(
+        {"impl": "hxloris.s3resolver.S3Resolver", "cache_root": str(tmp_path)}
+    )
+
+
+def test_copy_to_cache_not_found(resolver):
+    ident = "bucket-x/image.jpg"
+
+    with Stubber(resolver.s3) as stubber:
+        stubber.add_client_error(
+            "get_object",
+            "NoSuchKey",
+            http_status_code=404,
+            expected_params={"Bucket": "bucket-x", "Key": "image.jpg"},
+        )
+        with pytest.raises(ResolverException):
+            resolver.copy_to_cache(ident)
+        stubber.assert_no_pending_responses()
+
+    # no empty cache dir left to make is_resolvable() say yes
+    assert not os.path.exists(resolver.cache_dir_path(ident))
+
+
+class BrokenStream(io.RawIOBase):
+    """fails to read, once `ready` is set (or after a few seconds)."""
+
+    def __init__(self, ready):
+        self.ready = ready
+
+    def read(self, size=-1):
+        self.ready.wait(5)
+        raise IOError("connection reset")
+
+
+def add_broken_image_response(stubber, ready):
+    stubber.add_response(
+        "get_object",
+        {
+            "Body": StreamingBody(BrokenStream(ready), 1024),
+            "ContentLength": 1024,
+            "ContentType": "image/jpeg",
+        },
+        {"Bucket": "bucket-x", "Key": "image.jpg"},
+    )
+
+
+def rules_fetched_event(resolver, monkeypatch):
+    """returns event set once resolver fetched a rules file."""
+    fetched = threading.Event()
+    fetch_rules_file = resolver.fetch_rules_file
+
+    def fetch_and_set(*args):
+        try:
+            return fetch_rules_file(*args)
+        finally:
+            fetched.set()
+
+    monkeypatch.setattr(resolver, "fetch_rules_file", fetch_and_set)
+    return fetched
+
+
+def test_copy_to_cache_broken_download_leaves_no_cache_dir(resolver, monkeypatch):
+    ident = "bucket-x/image.jpg"
+    rules_fetched = rules_fetched_event(resolver, monkeypatch)
+
+    with Stubber(resolver.s3) as stubber:
+        # image download fails after the rules file is fetched
+        add_broken_image_response(stubber, rules_fetched)
+        stubber.add_response(
+            "get_object",
+            {"Body": StreamingBody(io.BytesIO(b"{}"), 2), "ContentLength": 2},
+            {"Bucket": "bucket-x", "Key": "image." + resolver.auth_rules_ext},
+        )
+        with pytest.raises(ResolverException):
+            resolver.copy_to_cache(ident)
+        stubber.assert_no_pending_responses()
+
+    assert not os.path.exists(resolver.cache_dir_path(ident))
+
+
+def test_copy_to_cache_failure_keeps_other_process_files(resolver, monkeypatch):
+    ident = "bucket-x/image.jpg"
+    rules_fetched = rules_fetched_event(resolver, monkeypatch)
+    # another process is about to publish the same image, rules first
+    cache_dir = resolver.cache_dir_path(ident)
+    os.makedirs(cache_dir)
+    other_files = sorted(["loris_cache." + resolver.auth_rules_ext, "tmpother"])
+    for fn in other_files:
+        open(os.path.join(cache_dir, fn), "w").close()
+
+    with Stubber(resolver.s3) as stubber:
+        add_broken_image_response(stubber, rules_fetched)
+        stubber.add_response(
+            "get_object",
+            {"Body": StreamingBody(io.BytesIO(b"{}"), 2), "ContentLength": 2},
+            {"Bucket": "bucket-x", "Key": "image." + resolver.auth_rules_ext},
+        )
+        with pytest.raises(ResolverException):
+            resolver.copy_to_cache(ident)
+
+    assert sorted(os.listdir(cache_dir)) == other_files
+
+
+def no_s3_calls(*args, **kwargs):
+    pytest.fail("unexpected s3 request")
+
+
+def test_is_resolvable_not_found_cached(resolver, monkeypatch):
+    ident = "bucket-x/missing.jpg"
+
+    with Stubber(resolver.s3) as stubber:
+        stubber.add_client_error(
+            "head_object",
+            "404",
+            http_status_code=404,
+            expected_params={"Bucket": "bucket-x", "Key": "missing.jpg"},
+        )
+        assert not resolver.is_resolvable(ident)
+        stubber.assert_no_pending_responses()
+
+    monkeypatch.setattr(resolver.s3, "head_object", no_s3_calls)
+    assert not resolver.is_resolvable(ident)
+
+
+def test_copy_to_cache_not_found_cached(resolver, monkeypatch):
+    ident = "bucket-x/missing.jpg"
+
+    with Stubber(resolver.s3) as stubber:
+        stubber.add_client_error("get_object", "NoSuchKey", http_status_code=404)
+        with pytest.raises(ResolverException):
+            resolver.copy_to_cache(ident)
+
+    monkeypatch.setattr(resolver.s3, "head_object", no_s3_calls)
+    assert not resolver.is_resolvable(ident)
+
+
+def s3_body(data):
+    return StreamingBody(io.BytesIO(data), len(data))
+
+
+def add_image_response(stubber, key, data, content_length=None):
+    stubber.add_response(
+        "get_object",
+        {
+            "Body": s3_body(data),
+            "ContentLength": len(data) if content_length is None else content_length,
+            "ContentType": "image/jpeg",
+        },
+        {"Bucket": "bucket-x", "Key": key},
+    )
+
+
+def test_copy_to_cache(resolver, monkeypatch):
+    ident = "bucket-x/dir/image.jpg"
+    monkeypatch.setattr(resolver.s3, "head_object", no_s3_calls)
+
+    with Stubber(resolver.s3) as stubber:
+        # content-type from the GET, no HEAD
+        add_image_response(stubber, "dir/image.jpg", b"image data")
+        stubber.add_client_error("get_object", "NoSuchKey", http_status_code=404)
+        local_fp = resolver.copy_to_cache(ident)
+        stubber.assert_no_pending_responses()
+
+    cache_dir = resolver.cache_dir_path(ident)
+    assert local_fp == os.path.join(cache_dir, "loris_cache.jpg")
+    with open(local_fp, "rb") as f:
+        assert f.read() == b"image data"
+    # no temp files left
+    assert os.listdir(cache_dir) == ["loris_cache.jpg"]
+    assert resolver.cached_file_for_ident(ident) == local_fp
+
+
+def test_copy_to_cache_unknown_format(resolver, monkeypatch):
+    ident = "bucket-x/image"
+
+    def format_from_ident(ident):
+        # as loris does, for an ident without extension
+        raise ResolverException("Format could not be determined for: %s." % ident)
+
+    monkeypatch.setattr(resolver, "format_from_ident", format_from_ident)
+
+    with Stubber(resolver.s3) as stubber:
+        stubber.add_response(
+            "get_object",
+            {
+                "Body": s3_body(b"image data"),
+                "ContentLength": 10,
+                "ContentType": "binary/octet-stream",
+            },
+            {"Bucket": "bucket-x", "Key": "image"},
+        )
+        with pytest.raises(ResolverException):
+            resolver.copy_to_cache(ident)
+        stubber.assert_no_pending_responses()
+
+    # nothing downloaded, no cache dir to make is_resolvable() say yes
+    assert not os.path.exists(resolver.cache_dir_path(ident))
+
+
+def test_copy_to_cache_rules_not_found(resolver, caplog):
+    ident = "bucket-x/dir/image.jpg"
+
+    with Stubber(resolver.s3) as stubber:
+        add_image_response(stubber, "dir/image.jpg", b"image data")
+        stubber.add_client_error(
+            "get_object",
+            "NoSuchKey",
+            http_status_code=404,
+            expected_params={
+                "Bucket": "bucket-x",
+                "Key": "dir/image." + resolver.auth_rules_ext,
+            },
+        )
+        resolver.copy_to_cache(ident)
+        stubber.assert_no_pending_responses()
+
+    # most images have no rules file, not worth a warning
+    assert os.listdir(resolver.cache_dir_path(ident)) == ["loris_cache.jpg"]
+    assert not [r for r in caplog.records if r.levelno >= logging.WARNING]
+
+
+def test_copy_to_cache_with_rules(resolver):
+    ident = "bucket-x/dir/image.jpg"
+
+    with Stubber(resolver.s3) as stubber:
+        add_image_response(stubber, "dir/image.jpg", b"image data")
+        stubber.add_response(
+            "get_object",
+            {"Body": s3_body(b'{"rules": 1}'), "ContentLength": 12},
+            {"Bucket": "bucket-x", "Key": "dir/image." + resolver.auth_rules_ext},
+        )
+        resolver.copy_to_cache(ident)
+        stubber.assert_no_pending_responses()
+
+    local_rules_fp = os.path.join(
+        resolver.cache_dir_path(ident), "loris_cache." + resolver.auth_rules_ext
+    )
+    with open(local_rules_fp, "rb") as f:
+        assert f.read() == b'{"rules": 1}'
+
+
+def test_copy_to_cache_large_object(resolver, monkeypatch):
+    ident = "bucket-x/image.jpg"
+    calls = []
+
+    def download_fileobj(bucketname, keyname, fileobj, Config=None):
+        calls.append((bucketname, keyname, Config))
+        fileobj.write(b"large image data")
+
+    monkeypatch.setattr(resolver.s3, "download_fileobj", download_fileobj)
+
+    with Stubber(resolver.s3) as stubber:
+        add_image_response(
+            stubber,
+            "image.jpg",
+            b"",
+            content_length=_TRANSFER_CFG.multipart_threshold,
+        )
+        stubber.add_client_error("get_object", "NoSuchKey", http_status_code=404)
+        local_fp = resolver.copy_to_cache(ident)
+        stubber.assert_no_pending_responses()
+
+    assert calls == [("bucket-x", "image.jpg", _TRANSFER_CFG)]
+    with open(local_fp, "rb") as f:
+        assert f.read() == b"large image data"
+
+
+def test_is_resolvable_found_cached(resolver, monkeypatch):
+    ident = "bucket-x/image.jpg"
+
+    with Stubber(resolver.s3) as stubber:
+        stubber.add_response(
+            "head_object",
+            {"ContentLength": 1024},
+            {"Bucket": "bucket-x", "Key": "image.jpg"},
+        )
+        assert resolver.is_resolvable(ident)
+        stubber.assert_no_pending_responses()
+
+    monkeypatch.setattr(resolver.s3, "head_object", no_s3_calls)
+    assert resolver.is_resolvable(ident)
+
+
+def test_copy_to_cache_already_cached_by_another_process(resolver):
+    ident = "bucket-x/image.jpg"
+    cache_dir = resolver.cache_dir_path(ident)
+    os.makedirs(cache_dir)
+    with open(os.path.join(cache_dir, "loris_cache.jpg"), "wb") as f:
+        f.write(b"cached by another process")
+
+    with Stubber(resolver.s3) as stubber:
+        add_image_response(stubber, "image.jpg", b"image data")
+        stubber.add_client_error("get_object", "NoSuchKey", http_status_code=404)
+        local_fp = resolver.copy_to_cache(ident)
+
+    assert local_fp == os.path.join(cache_dir, "loris_cache.jpg")
+    with open(local_fp, "rb") as f:
+        assert f.read() == b"cached by another process"
+    assert os.listdir(cache_dir) == ["loris_cache.jpg"]
+
+
+def link_error(err):
+    def link(src, dst):
+        raise OSError(err, os.strerror(err))
+
+    return link
+
+
+def test_copy_to_cache_no_hard_links(resolver, monkeypatch):
+    ident = "bucket-x/image.jpg"
+    monkeypatch.setattr(os, "link", link_error(errno.EPERM))
+
+    with Stubber(resolver.s3) as stubber:
+        add_image_response(stubber, "image.jpg", b"image data")
+        stubber.add_client_error("get_object", "NoSuchKey", http_status_code=404)
+        local_fp = resolver.copy_to_cache(ident)
+
+    cache_dir = resolver.cache_dir_path(ident)
+    with open(local_fp, "rb") as f:
+        assert f.read() == b"image data"
+    assert os.listdir(cache_dir) == ["loris_cache.jpg"]
+
+
+def test_copy_to_cache_link_error(resolver, monkeypatch):
+    ident = "bucket-x/image.jpg"
+    monkeypatch.setattr(os, "link", link_error(errno.EIO))
+
+    with Stubber(resolver.s3) as stubber:
+        add_image_response(stubber, "image.jpg", b"image data")
+        stubber.add_client_error("get_object", "NoSuchKey", http_status_code=404)
+        with pytest.raises(ResolverException):
+            resolver.copy_to_cache(ident)
+
+    # not published, and no temp file left behind
+    assert os.listdir(resolver.cache_dir_path(ident)) == []
+
+
+def test_copy_to_cache_rules_listing(tmp_path, caplog):
+    resolver = S3Resolver(
+        {
+            "impl": "hxloris.s3resolver.S3Resolver",
+            "cache_root": str(tmp_path),
+            "rules_listing_ttl": 60,
+        }
+    )
+    rules_key = "dir/image1." + resolver.auth_rules_ext
+
+    with Stubber(resolver.s3) as stubber:
+        add_image_response(stubber, "dir/image1.jpg", b"image1 data")
+        stubber.add_response(
+            "list_objects_v2",
+            {
+                "Contents": [{"Key": "dir/image1.jpg"}, {"Key": rules_key}],
+                "IsTruncated": False,
+            },
+            {"Bucket": "bucket-x", "Prefix": "dir/", "Delimiter": "/"},
+        )
+        stubber.add_response(
+            "get_object",
+            {"Body": s3_body(b"{}"), "ContentLength": 2},
+            {"Bucket": "bucket-x", "Key": rules_key},
+        )
+        resolver.copy_to_cache("bucket-x/dir/image1.jpg")
+
+        # listing remembered, and no rules file for image2: a single GET
+        add_image_response(stubber, "dir/image2.jpg", b"image2 data")
+        resolver.copy_to_cache("bucket-x/dir/image2.jpg")
+        stubber.assert_no_pending_responses()
+
+    rules_fn = "loris_cache." + resolver.auth_rules_ext
+    image1_dir = resolver.cache_dir_path("bucket-x/dir/image1.jpg")
+    image2_dir = resolver.cache_dir_path("bucket-x/dir/image2.jpg")
+    assert os.path.exists(os.path.join(image1_dir, rules_fn))
+    assert not os.path.exists(os.path.join(image2_dir, rules_fn))
+    assert not [r for r in caplog.records if r.levelno >= logging.WARNING]
+
+
+def test_copy_to_cache_saves_rules_before_image(resolver, monkeypatch):
+    ident = "bucket-x/image.jpg"
+    local_rules_fp = os.path.join(
+        resolver.cache_dir_path(ident), "loris_cache." + resolver.auth_rules_ext
+    )
+    link = os.link
+    rules_at_publish = []
+
+    def check_link(src, dst):
+        rules_at_publish.append(os.path.exists(local_rules_fp))
+        link(src, dst)
+
+    monkeypatch.setattr(os, "link", check_link)
+
+    with Stubber(resolver.s3) as stubber:
+        add_image_response(stubber, "image.jpg", b"image data")
+        stubber.add_response(
+            "get_object",
+            {"Body": s3_body(b"{}"), "ContentLength": 2},
+            {"Bucket": "bucket-x", "Key": "image." + resolver.auth_rules_ext},
+        )
+        resolver.copy_to_cache(ident)
+        stubber.assert_no_pending_responses()
+
+    assert rules_at_publish == [True]
+
+
+def test_cache_temp_file_dir_removed_meanwhile(tmp_path, monkeypatch):
+    cache_dir = str(tmp_path / "cache_dir")
+    makedirs = os.makedirs
+    calls = []
+
+    def makedirs_then_rmdir(path, exist_ok=False):
+        makedirs(path, exist_ok=exist_ok)
+        if not calls:
+            # a failed copy_to_cache cleaning up
+            os.rmdir(path)
+        calls.append(path)
+
+    monkeypatch.setattr(os, "makedirs", makedirs_then_rmdir)
+    with _cache_temp_file(cache_dir) as tmp_file:
+        assert os.path.dirname(tmp_file.name) == cache_dir
+    os.remove(tmp_file.name)
+
+
+def test_copy_to_cache_rules_fetch_workers_busy(resolver, monkeypatch):
+    ident = "bucket-x/image.jpg"
+    # all workers busy
+    monkeypatch.setattr(s3resolver, "_EXECUTOR_SLOTS", threading.Semaphore(0))
+    fetch_rules_file = resolver.fetch_rules_file
+    fetched_in = []
+
+    def record_thread(*args):
+        fetched_in.append(threading.current_thread())
+        return fetch_rules_file(*args)
+
+    monkeypatch.setattr(resolver, "fetch_rules_file", record_thread)
+
+    with Stubber(resolver.s3) as stubber:
+        add_image_response(stubber, "image.jpg", b"image data")
+        stubber.add_response(
+            "get_object",
+            {"Body": s3_body(b"{}"), "ContentLength": 2},
+            {"Bucket": "bucket-x", "Key": "image." + resolver.auth_rules_ext},
+        )
+        resolver.copy_to_cache(ident)
+        stubber.assert_no_pending_responses()
+
+    # fetched by the request thread, not queued behind other requests
+    assert fetched_in == [threading.current_thread()]
+    assert os.path.exists(
+        os.path.join(
+            resolver.cache_dir_path(ident), "loris_cache." + resolver.auth_rules_ext
+        )
+    )